@@ -1,7 +1,34 @@
-from typing import Dict, Type, TypeVar
+import re
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
+from html import unescape
+from threading import Lock
+from typing import Dict, List, Tuple, Type, TypeVar
 
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    import lxml  # noqa: F401
+except ImportError:
+    _PARSER = "html.parser"
+else:
+    _PARSER = "lxml"
+
+_MAIN = SoupStrainer("main")
+
+_FIELDS = "input[name], select[name], button[name]"
+
+_CSRF = re.compile(rb'<meta name="csrf-token" content="([^"]+)"')
+# Shown by Rails' stock 422 page, unlike forms re-rendered with validation errors.
+_CSRF_REJECTED = b"The change you wanted was rejected"
+
+_NEXT_LINK = re.compile(rb'<[a-z]+\s[^>]*(?<=\s)id="next_link"[^>]*>')
+_HREF = re.compile(rb'(?<=\s)href="([^"]*)"')
 
 
 _TElement = TypeVar("_TElement", bound="Element")
@@ -24,13 +51,42 @@ class StoryGraphAPI:
     COOKIE = "_storygraph_session"
     """Name of the session cookie produced by the website."""
 
+    POOL_SIZE = 8
+    """Maximum number of connections kept open to the website."""
+
+    PAGE_CACHE_SIZE = 256
+    """Maximum number of parsed pages kept by `page()`."""
+
+    SIGN_IN = "/users/sign_in"
+    """Path of the login page, which logged-out requests are redirected to."""
+
     username: str | None
     """Username of the currently logged-in user."""
 
     def __init__(self):
         self._session = Session()
-        self._csrf_param: str | None = None
+        # Only idempotent requests are retried, so form submissions never repeat
+        # (besides resending once if the server refused our CSRF token).
+        # The last response is returned as normal if the retries run out.
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.POOL_SIZE,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self._session.mount("https://", adapter)
         self._csrf_token: str | None = None
+        self._csrf_lock = Lock()
+        self._batch: List[Tuple["Element", str, bool, dict]] | None = None
+        self._batch_lock = Lock()
+        self._pages: OrderedDict[str, Tag] = OrderedDict()
+        self._pages_lock = Lock()
         self.username = None
 
     def request(self, method: str, path: str, **kwargs) -> Response:
@@ -47,101 +103,255 @@ class StoryGraphAPI:
         """
         return self.request("GET", path, **kwargs)
 
-    def post(self, path: str, form: dict | None = None, csrf = False, **kwargs) -> Response:
+    def post(
+        self,
+        path: str,
+        form: dict | None = None,
+        csrf = False,
+        owner: "Element | None" = None,
+        replace: bool = False,
+        **kwargs,
+    ) -> Response | None:
         """
         Make a `POST` request, optionally with form data or a CSRF token.
+
+        If an `owner` element is given and a `batch()` is in progress, the
+        request is queued and `None` is returned instead of a response.  With
+        `replace`, any request already queued for the same owner and path is
+        dropped in favour of this one.
         """
         if form:
             kwargs["data"] = form
         if csrf:
             kwargs.setdefault("headers", {})["X-CSRF-Token"] = self.csrf()
-        return self.request("POST", path, **kwargs)
+        if owner and self._batch is not None:
+            if replace:
+                self._batch[:] = [write for write in self._batch if write[:2] != (owner, path)]
+            self._batch.append((owner, path, csrf, kwargs))
+            return None
+        return self._submit(path, csrf, kwargs)
+
+    def _submit(self, path: str, csrf: bool, kwargs: dict) -> Response:
+        resp = self.request("POST", path, **kwargs)
+        if csrf and resp.status_code == 422 and _CSRF_REJECTED in resp.content:
+            # The session's token has been rotated, so fetch a new one and retry.
+            headers = kwargs["headers"]
+            headers["X-CSRF-Token"] = self._renew_csrf(headers["X-CSRF-Token"])
+            resp = self.request("POST", path, **kwargs)
+        return resp
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue up changes to elements made within the block, and submit them
+        together on exit.
+
+        Changes to each element are submitted in order, and the element is
+        reloaded once afterwards; separate elements are updated concurrently.
+        Nothing is submitted if the block raises an exception.  Batches can't be
+        nested, nor run from other threads whilst one is in progress.
+        """
+        queued: List[Tuple[Element, str, bool, dict]] = []
+        with self._batch_lock:
+            if self._batch is not None:
+                raise StoryGraphError("Batch already in progress")
+            self._batch = queued
+        try:
+            yield
+        except BaseException:
+            for owner, *_ in queued:
+                owner._queued.clear()
+            raise
+        finally:
+            self._batch = None
+        pending: Dict[Element, List[Tuple[str, bool, dict]]] = {}
+        for owner, path, csrf, kwargs in queued:
+            pending.setdefault(owner, []).append((path, csrf, kwargs))
+        with ThreadPoolExecutor(max_workers=self.POOL_SIZE) as pool:
+            for _ in pool.map(self._flush, pending.items()):
+                pass
 
-    def html(self, resp: Response) -> BeautifulSoup:
+    def _flush(self, item: Tuple["Element", List[Tuple[str, bool, dict]]]):
+        owner, writes = item
+        try:
+            for path, csrf, kwargs in writes:
+                self._submit(path, csrf, kwargs)
+        finally:
+            # Even if a change failed, the element can't rely on what was queued.
+            owner._queued.clear()
+            owner._reload()
+
+    def html(self, resp: Response, strainer: SoupStrainer | None = None) -> BeautifulSoup:
         """
-        Parse the HTML of a response.
+        Parse the HTML of a response, optionally keeping only the tags that
+        match a `strainer` (see also `html_main()`).
 
         If a CSRF token is present on the page, it will be captured for future
-        form submissions.
+        form submissions, whether or not its `<meta>` tag is kept.
+        """
+        self._scan_csrf(resp)
+        return BeautifulSoup(resp.content, _PARSER, parse_only=strainer, from_encoding="utf-8")
+
+    def html_main(self, resp: Response) -> Tag:
+        """
+        Parse just the `<main>` tag of a response.
+        """
+        return self.html(resp, _MAIN).main
+
+    def page(self, path: str) -> Tag:
+        """
+        Fetch and parse just the `<main>` tag of a page, reusing a previously
+        parsed copy of the same path if one is cached.
+
+        Error pages, sign-in redirects and pages without a `<main>` tag are
+        returned as-is but not cached, so the next lookup fetches them again.
         """
-        page = BeautifulSoup(resp.text, "html.parser")
-        if param := page.find("meta", {"name": "csrf-param"}):
-            self._csrf_param = param["content"]
-        if token := page.find("meta", {"name": "csrf-token"}):
-            self._csrf_token = token["content"]
-        return page
+        with self._pages_lock:
+            if path in self._pages:
+                self._pages.move_to_end(path)
+                return self._pages[path]
+        resp = self.get(path)
+        main = self.html_main(resp)
+        if not resp.ok or main is None or resp.url.endswith(self.SIGN_IN):
+            return main
+        with self._pages_lock:
+            self._pages[path] = main
+            if len(self._pages) > self.PAGE_CACHE_SIZE:
+                self._pages.popitem(last=False)
+        return main
+
+    def clear_cache(self, path: str | None = None):
+        """
+        Drop a single page from the cache used by `page()`, or all pages if no
+        path is given.
+        """
+        with self._pages_lock:
+            if path is None:
+                self._pages.clear()
+            else:
+                self._pages.pop(path, None)
+
+    def _scan_csrf(self, resp: Response):
+        if match := _CSRF.search(resp.content):
+            self._csrf_token = match[1].decode()
 
     def csrf(self) -> str:
         """
         Retrieve the cached CSRF token if one exists, otherwise fetch a new one
         from the home page.
+
+        Tokens are valid for the whole session, so the same one is reused until
+        a submission is rejected.  The home page isn't parsed, its CSRF meta
+        tag is just scanned from the raw response.
         """
-        if not self._csrf_token:
-            self.html(self.get("/"))
-        if not self._csrf_token:
-            raise StoryGraphError("No CSRF token")
-        csrf = self._csrf_token
-        self._csrf_token = None
-        return csrf
+        with self._csrf_lock:
+            if not self._csrf_token:
+                self._scan_csrf(self.get("/"))
+            if not self._csrf_token:
+                raise StoryGraphError("No CSRF token")
+            return self._csrf_token
+
+    def _renew_csrf(self, rejected: str) -> str:
+        # Batched writes run in parallel, so only drop the token if another
+        # thread hasn't already replaced it.
+        with self._csrf_lock:
+            if self._csrf_token == rejected:
+                self._csrf_token = None
+        return self.csrf()
 
-    def method(self, link: Tag) -> Response:
+    def method(self, link: Tag, owner: "Element | None" = None) -> Response | None:
         """
         Execute a [Turbo action][1] defined on an `<a>` link tag.
 
+        See `post()` for how `owner` is handled.
+
         [1]: https://turbo.hotwired.dev/handbook/drive
         """
-        data = {
-            "_method": link["data-method"],
-            self._csrf_param: self.csrf(),
-        }
-        return self.post(link["href"], data)
+        return self.post(link["href"], {"_method": link["data-method"]}, True, owner)
 
-    def form(self, form: Tag, data: Dict[str, str] | None = None, csrf: bool = False) -> Response:
+    def form_data(self, form: Tag) -> Tuple[str, Dict[str, str]]:
+        """
+        Extract the target path and existing input field values of a HTML form,
+        as plain strings that don't keep the parsed page alive.
+        """
+        data: Dict[str, str] = {}
+        for field in form.select(_FIELDS):
+            name: str = field["name"]
+            value: str
+            if field.name == "select":
+                option = field.find("option", selected=True)
+                if not option:
+                    continue
+                value = option.get("value", "")
+            else:
+                value = field.get("value", "")
+            data.setdefault(name, value)
+        return (form["action"], data)
+
+    def form(
+        self,
+        form: Tag | Tuple[str, Dict[str, str]],
+        data: Dict[str, str] | None = None,
+        csrf: bool = False,
+        owner: "Element | None" = None,
+        replace: bool = False,
+    ) -> Response | None:
         """
         Submit a HTML form, combining existing input fields with any custom
         form data, optionally with a CSRF token.
+
+        The form may be given as a tag, or as a path and fields already taken
+        from one by `form_data()`.
+
+        See `post()` for how `owner` and `replace` are handled.
         """
-        if not data:
-            data = {}
-        for type_ in ("input", "select", "button"):
-            for field in form.find_all(type_, {"name": True}):
-                name: str = field["name"]
-                value: str
-                if type_ == "select":
-                    option = field.find("option", selected=True)
-                    if not option:
-                        continue
-                    value = option.get("value", "")
-                else:
-                    value = field.get("value", "")
-                data.setdefault(name, value)
-        return self.post(form["action"], data, csrf)
+        if isinstance(form, Tag):
+            form = self.form_data(form)
+        action, fields = form
+        return self.post(action, {**fields, **(data or {})}, csrf, owner, replace)
 
     def paged(self, path: str, container: str, model: Type[_TElement], **kwargs):
         """
         Repeatedly follow the next page link when present on a page, and yield
         items as `Element`s as they're found within a container tag.
 
+        Only the container is parsed from each page, and the next page is
+        fetched in the background whilst the items of the current page are
+        being consumed.
+
         Additional arguments are passed to `get()`.
         """
-        while True:
-            page = self.html(self.get(path, **kwargs))
-            root = page.find(class_=container)
-            if not root:
-                break
-            for tag in root.find_all("div", recursive=False):
-                yield model(self, tag)
-            more = page.find(id="next_link")
-            if not isinstance(more, Tag):
-                break
-            path = more["href"]
+        strainer = SoupStrainer(class_=container)
+        pool = ThreadPoolExecutor(max_workers=1)
+        future: Future[Response] | None = pool.submit(self.get, path, **kwargs)
+        try:
+            while future:
+                resp = future.result()
+                more = self._next_link(resp)
+                future = pool.submit(self.get, more, **kwargs) if more else None
+                root = self.html(resp, strainer).find(class_=container)
+                if not root:
+                    break
+                for tag in root.find_all("div", recursive=False):
+                    yield model(self, tag)
+        finally:
+            if future:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    def _next_link(self, resp: Response) -> str | None:
+        if not (link := _NEXT_LINK.search(resp.content)):
+            return None
+        if not (href := _HREF.search(link[0])):
+            return None
+        return unescape(href[1].decode())
 
     def login(self, email: str, password: str):
         """
         Check if the user is currently logged in, and submit the login form
         with the given credentials if not.
         """
-        target = "/users/sign_in"
+        target = self.SIGN_IN
         resp = self.get(target)
         page = self.html(resp)
         if resp.url.endswith(target):
@@ -166,4 +376,22 @@ class Element:
 
     def __init__(self, sg: StoryGraphAPI, tag: Tag):
         self._sg = sg
-        self._tag: Tag = tag
+        self._root: Tag = tag
+        # Changes waiting in a batch, for later changes to build on.
+        self._queued: Dict[str, object] = {}
+
+    @property
+    def _tag(self) -> Tag:
+        return self._root
+
+    @cached_property
+    def _children(self) -> List[Tag]:
+        return [child for child in self._tag.children if isinstance(child, Tag)]
+
+    def _reload(self):
+        """
+        Forget any state made outdated by changes to the element.
+
+        Elements are fixed to the tag they were found in by default, so there's
+        nothing to do unless a subclass can fetch itself again.
+        """
@@ -1,4 +1,9 @@
 import json
+import os
+import stat
+import tempfile
+from contextlib import suppress
+from typing import Iterable, List
 
 from .api import StoryGraphAPI
 from .models import Book, Entry
@@ -14,7 +19,7 @@ class StoryGraph:
         """
         Initialise with `path` pointing at a writable JSON file, containing
         `email` and `password` fields.  This file will be updated on exit with
-        the session cookie, used by subsequent sessions.
+        the session cookie if it has changed, used by subsequent sessions.
         """
         self._path = path
         self._sg = StoryGraphAPI()
@@ -28,31 +33,77 @@ class StoryGraph:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._creds["cookie"] = self._sg._session.cookies.get(self._sg.COOKIE, domain=self._sg.DOMAIN)
-        with open(self._path, "w") as fp:
-            json.dump(self._creds, fp, indent=2)
+        cookie = self._sg._session.cookies.get(self._sg.COOKIE, domain=self._sg.DOMAIN)
+        if cookie == self._creds.get("cookie"):
+            return
+        creds = {**self._creds, "cookie": cookie}
+        # Write alongside the real file (following any symlink) and swap it in,
+        # keeping the original permissions as the file holds a password.
+        path = os.path.realpath(self._path)
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".staff-", suffix=".json")
+        try:
+            with open(fd, "w") as fp:
+                os.chmod(temp, mode)
+                json.dump(creds, fp, indent=2)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, path)
+        except BaseException:
+            with suppress(OSError):
+                os.unlink(temp)
+            raise
+        # Only remember the cookie as saved once it's actually been written.
+        self._creds = creds
+
+    def batch(self):
+        """
+        Context manager to collect changes to books and journal entries, and
+        submit them together on exit:
+
+            with sg.batch():
+                for book in books:
+                    book.status = Status.READ
+
+        Objects changed within the block aren't updated until it exits.  Repeat
+        edits to a journal entry are combined, but a book's status or owned
+        state can only be changed once per block.
+        """
+        return self._sg.batch()
 
     def get_book(self, path: str):
         """
         Retrieve a single book from a URL (e.g. a book's own page:
         `/books/020df915-11d0-405f-a1e7-dce262b4a255`).
+
+        Pages are cached, so repeat lookups of the same book don't fetch it
+        again until it's changed or the cache is cleared.
+        """
+        return Book(self._sg, self._sg.page(path))
+
+    def clear_cache(self):
+        """
+        Forget any cached book pages, so that subsequent lookups fetch them
+        again.
+        """
+        self._sg.clear_cache()
+
+    def prefetch_metadata(self, books: Iterable[Book], workers: int | None = None) -> List[Book]:
+        """
+        Load `metadata` for many books at once, as per `Book.prefetch_metadata()`.
         """
-        resp = self._sg.get(path)
-        page = self._sg.html(resp)
-        return Book(self._sg, page.main)
+        return Book.prefetch_metadata(books, workers)
 
     def import_book(self, isbn: str):
         """
         Lookup or import a book by its ISBN (10 or 13 characters).
         """
         path = "/import-book-isbn"
-        resp = self._sg.get(path)
-        page = self._sg.html(resp)
-        form = page.main.find("form", action=path)
-        resp = self._sg.form(form, {"isbn": isbn})
-        page = self._sg.html(resp)
-        if page.find(class_="book-title-author-and-series"):
-            return Book(self._sg, page.main)
+        page = self._sg.html_main(self._sg.get(path))
+        form = page.find("form", action=path)
+        page = self._sg.html_main(self._sg.form(form, {"isbn": isbn}))
+        if page and page.find(class_="book-title-author-and-series"):
+            return Book(self._sg, page)
         else:
             return None
 
@@ -1,11 +1,23 @@
-from datetime import date, datetime
+import calendar
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from enum import Enum, IntEnum, auto
 from functools import cached_property
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Tuple
+from urllib.parse import urlsplit
 
 from bs4 import Tag
+from requests import Response
 
-from .api import Element, StoryGraphError
+from .api import Element, StoryGraphAPI, StoryGraphError
+
+
+_PAGES = re.compile(r"^\s*(\d+)\s+pages\s*$")
+_PROGRESS = re.compile(r"(Started)|(Finished)|(Did not finish)|^(\d+)%$", re.M)
+
+_DATE = re.compile(r"(?:(\d{1,2})\s+)?(?:([A-Za-z]+)\s+)?(\d{4})")
+_MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
 
 
 def _setter(fn):
@@ -33,6 +45,13 @@ class Status(Enum):
     """Book was started but not completed in the past."""
 
 
+_STATUS_FORMS = {
+    status: f'form[action*="/update-status"][action*="={status.value.replace(" ", "-")}"]'
+    for status in Status
+}
+_STATUS_FORMS[Status.NONE] = 'form[action*="/remove-book/"]'
+
+
 class Progress(Enum):
     """
     Reading state of an entry.
@@ -81,27 +100,40 @@ class DateAccuracy(IntEnum):
             when = (when, DateAccuracy.DAY)
         return when
 
+    @classmethod
+    def _parse(cls, text: str) -> Tuple[None, None] | Tuple[date, "DateAccuracy"] | None:
+        text = text.strip()
+        if text == "No date":
+            return (None, None)
+        match = _DATE.fullmatch(text)
+        if not match:
+            return None
+        day, month, year = match.groups()
+        if month:
+            number = _MONTHS.get(month.lower())
+            accuracy = cls.DAY if day else cls.MONTH
+        elif day:
+            return None
+        else:
+            number = 1
+            accuracy = cls.YEAR
+        if not number:
+            return None
+        try:
+            return (date(int(year), number, int(day or 1)), accuracy)
+        except ValueError:
+            return None
+
     @classmethod
     def parse(cls, text: str) -> Tuple[None, None] | Tuple[date, "DateAccuracy"]:
         """
         Convert a textual date of any accuracy to a Python `date` and the
         corresponding `DateAccuracy`.
         """
-        if text == "No date":
-            return (None, None)
-        for pattern, accuracy in (
-            ("%d %B %Y", cls.DAY),
-            ("%B %Y", cls.MONTH),
-            ("%Y", cls.YEAR),
-        ):
-            try:
-                when = datetime.strptime(text, pattern)
-            except ValueError:
-                continue
-            else:
-                return (when.date(), accuracy)
-        else:
+        when = cls._parse(text)
+        if not when:
             raise StoryGraphError(f"Can't parse date: {text!r}")
+        return when
 
     @classmethod
     def unparse(cls, when: date | None, accuracy: "DateAccuracy") -> str:
@@ -119,59 +151,62 @@ class DateAccuracy(IntEnum):
         return when.strftime(pattern)
 
 
+def _date_fields(key: str) -> Tuple[Tuple[DateAccuracy, str, str], ...]:
+    return tuple((part, part.name.lower(), key.format(part.name.lower())) for part in DateAccuracy)
+
+
+_READ_START_FIELDS = _date_fields("read_instance[start_{}]")
+_READ_END_FIELDS = _date_fields("read_instance[{}]")
+_ENTRY_FIELDS = _date_fields("journal_entry[{}]")
+
+
 class Book(Element):
     """
     Representation of an individual book.
     """
 
-    @property
+    @cached_property
     def _path(self) -> str:
-        for link in self._tag.find_all("a"):
-            if link["href"].startswith("/books/"):
-                return "/".join(link["href"].split("/", 3)[:3])
-        else:
+        # Read from the current tag even if outdated, as needed to reload it.
+        link: Tag | None = self._root.select_one('a[href^="/books/"]')
+        if not link:
             raise StoryGraphError("No self link")
+        return "/".join(link["href"].split("/", 3)[:3])
 
     @property
     def _id(self) -> str:
         return self._path.rsplit("/", 1)[-1]
 
-    @property
+    @cached_property
     def _info(self) -> Tag:
         return self._tag.find(class_="book-title-author-and-series")
 
-    @property
+    @cached_property
     def _title_author_series(self) -> Tuple[str, List[str], str | None, str | None]:
-        root: Tag = self._tag.find(class_="book-title-author-and-series")
+        root = self._info
         title = series = number = None
         authors: List[str] = []
-        for link in root.find_all("a"):
-            type_ = link["href"].split("/", 2)[1]
-            if type_ == "books":
+        for link in root.find_all("a", href=True):
+            href: str = link["href"]
+            if href.startswith("/books/"):
                 title = link.text
-            elif type_ == "authors":
+            elif href.startswith("/authors/"):
                 authors.append(link.text)
-            elif type_ == "series":
+            elif href.startswith("/series/"):
                 if not series:
                     series = link.text
-                elif link.text[0] == "#":
+                elif link.text.startswith("#"):
                     number = link.text[1:]
         if not title:
             title = root.h3.find(string=True).strip()
         return (title, authors, series, number)
 
-    @cached_property
-    def _editions_page(self):
-        return self._sg.html(self._sg.get(f"{self._path}/editions")).main
-
-    @cached_property
-    def metadata(self) -> Dict[str, str | None]:
-        """
-        Edition-specific information, such as format, ISBN and language.
-        """
+    def _read_metadata(self) -> Dict[str, str | None]:
+        # Kept apart from the cached property so that it can run on many books
+        # at once (`cached_property` locks across instances before Python 3.12).
         block: Tag | None = self._tag.find(class_="edition-info")
         if not block:
-            block = self._editions_page.find(class_="edition-info")
+            block = self._sg.page(f"{self._path}/editions").find(class_="edition-info")
         data: Dict[str, str | None] = {}
         for line in block.find_all("p"):
             field, value = (node.text.strip() for node in line.children)
@@ -180,6 +215,29 @@ class Book(Element):
             data[field.rstrip(":")] = value
         return data
 
+    @cached_property
+    def metadata(self) -> Dict[str, str | None]:
+        """
+        Edition-specific information, such as format, ISBN and language.
+        """
+        return self._read_metadata()
+
+    @classmethod
+    def prefetch_metadata(cls, books: Iterable["Book"], workers: int | None = None) -> List["Book"]:
+        """
+        Load `metadata` for many books at once, fetching any pages it needs in
+        parallel (by default using as many workers as the session has
+        connections), and return the books as a list.
+        """
+        books = list(books)
+        todo = [book for book in books if "metadata" not in book.__dict__]
+        if not todo:
+            return books
+        with ThreadPoolExecutor(max_workers=workers or todo[0]._sg.POOL_SIZE) as pool:
+            for book, metadata in zip(todo, pool.map(cls._read_metadata, todo)):
+                book.__dict__["metadata"] = metadata
+        return books
+
     @property
     def title(self) -> str:
         """
@@ -208,18 +266,20 @@ class Book(Element):
         """
         return self._title_author_series[2:]
 
-    @property
+    @cached_property
     def pages(self) -> int | None:
         """
         Number of pages in the book.
         """
-        for text in self._tag.find_all(string=True):
-            text: str
-            parts = text.split()
-            if len(parts) == 2 and parts[1] == "pages" and parts[0].isdigit():
-                return int(parts[0])
+        if text := self._tag.find(string=_PAGES):
+            return int(_PAGES.match(text)[1])
         return None
 
+    @cached_property
+    def _status(self) -> Status:
+        label = self._tag.find(class_="read-status-label")
+        return Status(label.text) if label else Status.NONE
+
     @property
     def status(self) -> Status:
         """
@@ -228,24 +288,29 @@ class Book(Element):
         This is a writable field which sets the new status, generating any
         corresponding journal entries and updating any read-throughs.
         """
-        label = self._tag.find(class_="read-status-label")
-        return Status(label.text) if label else Status.NONE
+        return self._queued.get("status", self._status)
 
     @status.setter
     def status(self, new: Status):
         if self.status == new:
             return
-        for form in self._tag.find_all("form"):
-            if new is Status.NONE:
-                if "/remove-book/" in form["action"]:
-                    break
-            else:
-                if "/update-status" in form["action"] and ("=" + new.value.replace(" ", "-")) in form["action"]:
-                    break
-        else:
+        if "status" in self._queued:
+            raise StoryGraphError("Status already changed in this batch")
+        form: Tag | None = self._tag.select_one(_STATUS_FORMS[new])
+        if not form:
             raise StoryGraphError("No update status form")
-        self._sg.form(form)
-        self._reload()
+        # Status changes start or end read-throughs, unlike other changes.
+        self._changed(self._sg.form(form, owner=self), reads=True, status=new)
+
+    @cached_property
+    def _own_links(self) -> Tuple[Tag | None, Tag | None]:
+        own = unown = None
+        for link in self._tag.select(".mark-as-owned-link, .remove-from-owned-link"):
+            if "remove-from-owned-link" in link["class"]:
+                unown = unown or link
+            else:
+                own = own or link
+        return (own, unown)
 
     @property
     def owned(self) -> bool:
@@ -254,16 +319,18 @@ class Book(Element):
 
         This is a writable field which can toggle the owned status.
         """
-        return self._tag.find(class_="remove-from-owned-link") is not None
+        return self._queued.get("owned", self._own_links[1] is not None)
 
     @owned.setter
     def owned(self, owned: bool):
-        class_ = "mark-as-owned-link" if owned else "remove-from-owned-link"
-        link: Tag | None = self._tag.find(class_=class_)
+        if "owned" in self._queued:
+            if self._queued["owned"] == owned:
+                return
+            raise StoryGraphError("Owned state already changed in this batch")
+        link = self._own_links[0 if owned else 1]
         if not link:
             return
-        self._sg.method(link)
-        self._reload()
+        self._changed(self._sg.method(link, owner=self), owned=owned)
 
     def _update_progress(self, unit: str, value: int):
         form: Tag = self._tag.find("form", action="/update-progress")
@@ -271,7 +338,7 @@ class Book(Element):
             "read_status[progress_number]": str(value),
             "read_status[progress_type]": unit,
         }
-        self._sg.form(form, data, True)
+        self._changed(self._sg.form(form, data, True, owner=self))
 
     @_setter
     def pages_read(self, pages: int):
@@ -293,7 +360,7 @@ class Book(Element):
 
     @cached_property
     def _reads_page(self) -> Tag:
-        return self._sg.html(self._sg.get(f"/read_instances/new?book_id={self._id}")).main
+        return self._sg.html_main(self._sg.get(f"/read_instances/new?book_id={self._id}"))
 
     def reads(self) -> List["Read"]:
         """
@@ -303,7 +370,7 @@ class Book(Element):
         reads: List[Read] = []
         for row in panel.find_all("p", recursive=False):
             if row.find(class_="edit-read-instance"):
-                reads.append(Read(self._sg, row))
+                reads.append(Read(self._sg, row, self))
         return reads
 
     def other_editions(self):
@@ -314,13 +381,46 @@ class Book(Element):
         """
         return self._sg.paged(f"{self._path}/editions", "search-results-books-panes", Book)
 
+    _stale = False
+    _response: Response | None = None
+
+    @property
+    def _tag(self) -> Tag:
+        if self._stale:
+            self._stale = False
+            self._root = self._fetch()
+        return self._root
+
+    def _fetch(self) -> Tag:
+        resp, self._response = self._response, None
+        if resp is not None and (main := self._sg.html_main(resp)):
+            return main
+        return self._sg.page(self._path)
+
+    def _changed(self, resp: Response | None, reads: bool = False, **queued):
+        if reads:
+            self.__dict__.pop("_reads_page", None)
+        # Nothing more to do yet if the change was queued by a batch, other than
+        # noting any new values for the rest of the batch to check against.
+        if resp is None:
+            self._queued.update(queued)
+            return
+        self._reload()
+        # Changes usually redirect back to the book, so keep that page to parse
+        # instead of fetching it again.
+        if urlsplit(resp.url).path == self._path:
+            self._response = resp
+
     def _reload(self):
-        resp = self._sg.get(self._path)
-        page = self._sg.html(resp)
-        self._tag = page.main
+        # Fetch the book's page again on next access.
+        self._stale = True
+        self._sg.clear_cache(self._path)
+        for attr in ("_info", "_title_author_series", "pages", "_status", "_own_links"):
+            self.__dict__.pop(attr, None)
 
     def __repr__(self):
-        return f"<{self.__class__.__name__}: {self.author!r} {self.title!r}>"
+        title, authors, _, _ = self._title_author_series
+        return f"<{self.__class__.__name__}: {next(iter(authors), None)!r} {title!r}>"
 
 
 class Read(Element):
@@ -328,13 +428,16 @@ class Read(Element):
     Representation of a single read-through of a book.
     """
 
+    def __init__(self, sg: StoryGraphAPI, tag: Tag, book: Book):
+        super().__init__(sg, tag)
+        self._book = book
+
     @property
     def _start_end(self) -> Tuple[str, str]:
-        for text in self._tag.find_all(string=True):
-            if " to " in text:
-                return tuple(text.strip().split(" to ", 1))
-        else:
+        text = self._tag.find(string=lambda text: " to " in text)
+        if not text:
             raise StoryGraphError("No read dates")
+        return tuple(text.strip().split(" to ", 1))
 
     @property
     def start(self) -> Tuple[None, None] | Tuple[date, DateAccuracy]:
@@ -383,23 +486,19 @@ class Read(Element):
         form: Tag = panel.find("form")
         data = {}
         if start:
-            for part in DateAccuracy:
-                field = part.name.lower()
-                value = getattr(start, field) if start_accuracy >= part else ""
-                data[f"read_instance[start_{field}]"] = value
+            for part, field, key in _READ_START_FIELDS:
+                data[key] = getattr(start, field) if start_accuracy >= part else ""
         if end:
-            for part in DateAccuracy:
-                field = part.name.lower()
-                value = getattr(end, field) if end_accuracy >= part else ""
-                data[f"read_instance[{field}]"] = value
-        self._sg.form(form, data, True)
+            for part, field, key in _READ_END_FIELDS:
+                data[key] = getattr(end, field) if end_accuracy >= part else ""
+        self._book._changed(self._sg.form(form, data, True), reads=True)
 
     def delete(self):
         """
         Delete this read-through.
         """
         link: Tag = self._tag.find("a", {"data-method": "delete"})
-        self._sg.method(link)
+        self._book._changed(self._sg.method(link), reads=True)
 
     def __repr__(self):
         return f"<{self.__class__.__name__}: {DateAccuracy.unparse(*self.start)} -> {DateAccuracy.unparse(*self.end)}>"
@@ -410,9 +509,9 @@ class Entry(Element):
     Representation of a single journal entry within a read-through.
     """
 
-    @property
+    @cached_property
     def _date_title_progress(self) -> Tuple[Tag, Tag, Tag]:
-        right = self._tag.find_all(recursive=False)[1]
+        right = self._children[1]
         return tuple(right.find_all(recursive=False)[:3])
 
     @property
@@ -421,15 +520,22 @@ class Entry(Element):
 
     @property
     def _edit_link(self) -> str:
-        for link in self._date_title_progress[0].find_all("a"):
-            if link["href"].startswith("/journal_entries/"):
-                return link["href"]
-        else:
+        link: Tag | None = self._date_title_progress[0].select_one('a[href^="/journal_entries/"]')
+        if not link:
             raise StoryGraphError("No entry edit page")
+        return link["href"]
 
     @cached_property
     def _edit_page(self) -> Tag:
-        return self._sg.html(self._sg.get(self._edit_link)).main
+        return self._sg.page(self._edit_link)
+
+    @cached_property
+    def _when(self) -> Tuple[None, None] | Tuple[date, DateAccuracy]:
+        for text in self._date_title_progress[0].stripped_strings:
+            if when := DateAccuracy._parse(text):
+                return when
+        else:
+            raise StoryGraphError("No entry date")
 
     @property
     def when(self) -> Tuple[None, None] | Tuple[date, DateAccuracy]:
@@ -440,13 +546,7 @@ class Entry(Element):
         either a date/accuracy tuple or just the date (`DateAccuracy.DAY` is
         assumed).
         """
-        for text in self._date_title_progress[0].find_all(string=True):
-            try:
-                return DateAccuracy.parse(text)
-            except StoryGraphError:
-                pass
-        else:
-            raise StoryGraphError("No entry date")
+        return self._when
 
     @when.setter
     def when(self, when: date | None | Tuple[date | None, DateAccuracy]):
@@ -470,18 +570,20 @@ class Entry(Element):
             raise StoryGraphError("Can't derive author")
         return combined[len(prefix):]
 
-    @property
+    @cached_property
     def _progress_percent(self) -> Tuple[Progress, int]:
         progress = Progress.UPDATED
-        for text in self._date_title_progress[2].find_all(string=True):
-            if "Started" in text:
+        text = self._date_title_progress[2].get_text("\n", strip=True)
+        for match in _PROGRESS.finditer(text):
+            started, finished, abandoned, percent = match.groups()
+            if started:
                 return Progress.STARTED, 0
-            elif "Finished" in text:
+            elif finished:
                 return Progress.FINISHED, 100
-            elif "Did not finish" in text:
+            elif abandoned:
                 progress = Progress.DID_NOT_FINISH
-            elif text.endswith("%"):
-                return progress, int(text[:-1])
+            else:
+                return progress, int(percent)
         else:
             raise StoryGraphError("No entry progress")
 
@@ -499,8 +601,15 @@ class Entry(Element):
         """
         return self._progress_percent[1]
 
+    @cached_property
+    def _edit_inputs(self) -> Dict[str, str]:
+        return {
+            field["name"]: field.get("value", "")
+            for field in self._edit_page.select('input[name^="journal_entry["]')
+        }
+
     def _edit_input(self, name: str) -> int:
-        return int(self._edit_page.find("input", {"name": name})["value"])
+        return int(self._edit_inputs[name])
 
     @property
     def pages(self) -> int:
@@ -545,9 +654,7 @@ class Entry(Element):
         """
         Retrieve the book being read from this entry.
         """
-        resp = self._sg.get(self._title["href"])
-        page = self._sg.html(resp)
-        return Book(self._sg, page.main)
+        return Book(self._sg, self._sg.page(self._title["href"]))
 
     def edit(
         self,
@@ -560,35 +667,44 @@ class Entry(Element):
         """
         Change the date or progress in this entry.
         """
-        form: Tag = self._edit_page.find("form", {"class": "edit_journal_entry"})
+        # Build on any edit already queued in a batch, as the page won't show it.
+        form = self._queued.get("form")
+        if not form:
+            form = self._sg.form_data(self._edit_page.find("form", {"class": "edit_journal_entry"}))
         data: Dict[str, str] = {}
         if when:
-            for part in DateAccuracy:
-                field = part.name.lower()
-                value = getattr(when, field) if accuracy >= part else ""
-                data[f"journal_entry[{field}]"] = value
+            for part, field, key in _ENTRY_FIELDS:
+                data[key] = getattr(when, field) if accuracy >= part else ""
         if pages is not None:
             data["journal_entry[pages_read]"] = str(pages)
         if pages_total is not None:
             data["journal_entry[pages_read_total]"] = str(pages_total)
         if percent is not None:
             data["journal_entry[percent_reached]"] = str(percent)
-        self._sg.form(form, data)
+        # Let go of the edit page before submitting, as it's now outdated.
         self._reload()
+        # Each queued edit carries all of the earlier ones, so only the last is sent.
+        if self._sg.form(form, data, owner=self, replace=True) is None:
+            action, fields = form
+            self._queued["form"] = (action, {**fields, **data})
 
     def delete(self):
         """
         Delete this entry.
         """
-        for link in self._edit_page.find_all("a"):
-            if link.get("data-method") == "delete" and link["href"].startswith("/journal_entries/"):
-                self._sg.method(link)
-                return
-        else:
+        link: Tag | None = self._edit_page.select_one('a[data-method="delete"][href^="/journal_entries/"]')
+        if not link:
             raise StoryGraphError("No delete link")
+        self._sg.method(link)
+        self._reload()
 
     def _reload(self):
-        del self._edit_page
+        for attr in ("_edit_page", "_edit_inputs"):
+            self.__dict__.pop(attr, None)
+        self._sg.clear_cache(self._edit_link)
+        # The book's page shows its latest progress, which may have changed.
+        self._sg.clear_cache(self._title["href"])
 
     def __repr__(self):
-        return f"<{self.__class__.__name__}: {self.title!r} {self.progress.name} {self.progress_percent}%>"
+        progress, percent = self._progress_percent
+        return f"<{self.__class__.__name__}: {self.title!r} {progress.name} {percent}%>"